@@ -7,25 +7,64 @@ in Android (like androidx.appcompat).
 - FastAPI: The web framework that makes building REST APIs easy
 - WebSocket: For real-time bidirectional communication (we'll use this later)
 - HTTPException: For throwing HTTP errors (like 404 Not Found, 500 Internal Server Error)
+- Query: Lets us put limits on a query parameter (like "between 1 and 500")
 - HTMLResponse/StreamingResponse: Special response types for returning HTML or streams
+- ORJSONResponse: Returns JSON using orjson, a JSON library written in Rust that's much faster
+  than Python's built-in json module
 - StaticFiles: For serving static files (CSS, JS, images)
+- GZipMiddleware: Compresses our responses before they're sent (see below)
 - BaseModel: From pydantic, helps us define data models with automatic validation
+- field_validator: Lets a model run our own extra checks on a field (see BatchItem)
 - sqlite3: Python's built-in SQLite database library
+- threading: Locks that stop two threads from changing the same thing at once (see get_db below)
+- queue/Future: Hand messages to a background writer thread and wait for the result
+- anyio: The async library FastAPI is built on; we use it to size FastAPI's thread pool
+- time: Gives us the current time as a plain number (see micros_to_datetime below)
+- orjson: The fast JSON library behind ORJSONResponse, used directly when streaming
+- asyncio/httpx: Run several requests at the same time for the /api/batch endpoint
+- typing: Optional[...] marks a field that can be left out (None)
+- contextmanager: Lets us write our own `with ...:` blocks (see write_transaction below)
+- hashlib: Makes a short fingerprint of the landing page so browsers can skip re-downloading it
 '''
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 from datetime import datetime
-from fastapi import FastAPI, WebSocket, HTTPException
-from fastapi.responses import HTMLResponse, StreamingResponse
+from typing import Any, List, Optional
+from fastapi import FastAPI, WebSocket, HTTPException, Query, Request
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response, StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, field_validator
+import anyio
+import asyncio
+import hashlib
+import httpx
+import orjson
+import queue
 import sqlite3
+import threading
+import time
 
 '''
 Create our FastAPI application instance. This 'app' object is the core of our backend.
 All our endpoints (@app.get, @app.post) are attached to this app object.
 
 When we run the server at the bottom, we pass this app to uvicorn to run it.
+
+default_response_class=ORJSONResponse tells FastAPI to turn everything we return into
+JSON with orjson instead of the slower built-in json module.
+'''
+app = FastAPI(default_response_class=ORJSONResponse)
+
 '''
-app = FastAPI()
+Middleware is code that runs on every request/response, around our endpoints.
+GZipMiddleware compresses any response bigger than 512 bytes (if the client says it
+accepts gzip, which browsers and mobile HTTP libraries do). Chat history JSON repeats the
+same keys and names over and over ("sender", "displayName", "Khader A. Murtaja", ...),
+so it shrinks a lot - much less data to send over a slow mobile connection.
+Tiny responses aren't worth the effort of compressing, hence minimum_size.
+'''
+app.add_middleware(GZipMiddleware, minimum_size=512)
 
 # Models
 
@@ -52,6 +91,51 @@ class Message(BaseModel):
     content: str
     timestamp: datetime
 
+'''
+These two describe the body of a POST /api/batch request (see batch() further down):
+a list of smaller requests, each with an id we echo back so the app can match them up.
+
+The @field_validator functions run when FastAPI reads the request body. If one raises a
+ValueError, FastAPI answers 422 with our message and batch() never runs. We check that:
+- method is one we know (so a typo can't crash the batch halfway through)
+- url is a path on this server, like "/api/message?userId=khader". httpx.URL splits it into
+  its parts; anything with a scheme ("http:") or host ("//somewhere") is refused, so a
+  batch can only ever call our own endpoints.
+- url isn't /api/batch itself. We compare the parsed path, so tricks like
+  "/api/%62atch" (%62 is "b") or "/api/batch?x=1" are caught too.
+'''
+BATCH_METHODS = {"GET", "POST", "PUT", "PATCH", "DELETE"}
+
+class BatchItem(BaseModel):
+    id: str
+    method: str
+    url: str
+    body: Optional[Any] = None
+
+    @field_validator("method")
+    @classmethod
+    def _check_method(cls, method: str):
+        method = method.upper()
+        if method not in BATCH_METHODS:
+            raise ValueError(f"method must be one of {', '.join(sorted(BATCH_METHODS))}")
+        return method
+
+    @field_validator("url")
+    @classmethod
+    def _check_url(cls, url: str):
+        try:
+            parsed = httpx.URL(url)
+        except httpx.InvalidURL:
+            raise ValueError("url is not a valid URL")
+        if parsed.scheme or parsed.host or not url.startswith("/") or url.startswith("//"):
+            raise ValueError("url must be a path on this server, like /api/message?userId=khader")
+        if parsed.path.rstrip("/") == "/api/batch":
+            raise ValueError("/api/batch can't be called from inside a batch")
+        return url
+
+class BatchRequest(BaseModel):
+    requests: List[BatchItem]
+
 # Util functions
 '''
 Util functions is a generic name for any function that exists only to help other functions.
@@ -63,19 +147,398 @@ you should write a util function to avoid repeating the same code block and mayb
 2. You want to make the original function cleaner by replacing multiple lines of code with one
 function call. 
 '''
-def parse_time(time_str: str):
-    """Convert SQLite timestamp str to datetime object"""
+def micros_to_datetime(micros: int):
+    """Convert a stored timestamp (microseconds since 1970) to a datetime object"""
+    '''
+    We store each message's timestamp in the database as one whole number: the number of
+    microseconds since January 1st 1970 (the "Unix epoch"). time.time_ns() // 1000 gives
+    us that number for right now. Computers compare and sort whole numbers much faster than
+    text like "2025-01-15 14:30:45.123456", and there's no text to parse when we read it back.
+
+    Our API still sends timestamps as normal dates, so this turns the number back into
+    a Python datetime object. // is whole-number division and % is the remainder, so
+    we split the number into whole seconds and leftover microseconds. We avoid dividing
+    by 1,000,000 with decimals because floating point numbers can be off by a microsecond.
     '''
-    This function takes a timestamp as a string (like "2025-01-15 14:30:45.123456")
-    and converts it into a Python datetime object that we can work with.
+    return datetime.fromtimestamp(micros // 1_000_000).replace(microsecond=micros % 1_000_000)
+
+# Database connections
+'''
+Opening a SQLite connection isn't free: the file has to be opened, the schema parsed, and
+the connection's page cache starts out empty. Doing that on every single request costs more
+than the tiny queries we actually run.
+
+Instead we keep connections around and reuse them, and we split them by job:
+
+- Readers: a small pool of at most READER_POOL_SIZE read-only connections. `with get_db() as
+  conn:` borrows one for the length of the with block and puts it back afterwards, so two
+  requests never share a connection mid-query. In WAL mode any number of readers can read at
+  the same time, even while a write is happening. Every connection keeps its own page cache
+  (up to 64MB, see cache_size below), so we don't give each of FastAPI's worker threads its
+  own connection: with THREADPOOL_SIZE threads that could add up to gigabytes per process.
+- Writer: SQLite only ever lets one connection write at a time anyway, so every write in
+  this process goes through one shared connection (get_writer), one at a time
+  (write_transaction), and readers never wait for it. Each uvicorn worker is a separate
+  process with its own writer, though, so writers from different workers can still collide
+  inside SQLite - busy_timeout (below) is what makes them wait their turn instead of failing.
+
+check_same_thread=False lets a connection be used from a thread other than the one that
+opened it - the writer is shared between threads, and at shutdown the main thread closes
+connections that were opened by the worker threads.
+'''
+DB_PATH = 'storage/cipher.db'
+READER_POOL_SIZE = 8
+READER_WAIT_TIMEOUT = 10
+_readers = queue.LifoQueue()  # reader connections nobody is using right now
+_connections = []  # every reader connection we opened
+_connections_lock = threading.Lock()
+_writer_conn = None
+_write_lock = threading.Lock()
+
+def _connect(readonly: bool = False):
+    """Open a new SQLite connection with our settings applied"""
+    '''
+    Read-only connections are opened with a "file:" URI ending in ?mode=ro, which makes
+    SQLite refuse any write through them - so a reader can never accidentally write.
+
+    isolation_level='IMMEDIATE' means every transaction that writes starts with BEGIN IMMEDIATE:
+    it grabs the write lock up front (waiting for it if needed, see busy_timeout below)
+    instead of finding out halfway through that another connection is already writing.
+    '''
+    path, uri = (f'file:{DB_PATH}?mode=ro', True) if readonly else (DB_PATH, False)
+    conn = sqlite3.connect(path, uri=uri, check_same_thread=False, cached_statements=256,
+                           isolation_level='IMMEDIATE')
+    # lets us read columns by name (row['content']) as well as by index (row[0])
+    conn.row_factory = sqlite3.Row
+    '''
+    PRAGMAs are SQLite's settings. We set them once per connection, right when it opens:
+    - journal_mode=WAL: writes go to a write-ahead log, so readers (fetchMessages) don't
+      block the writer (message) and vice versa. This one is saved in the db file itself,
+      and switching it is a write - so only the writer sets it (a read-only connection
+      would fail with "attempt to write a readonly database").
+    - synchronous=NORMAL: in WAL mode this is still safe against crashes but skips most fsyncs.
+    - temp_store=MEMORY: temporary tables/indexes (e.g. for sorting) live in RAM, not on disk.
+    - cache_size=-64000: keep up to ~64MB of pages cached (negative means KiB, not pages).
+    - mmap_size: let SQLite read the file through memory-mapping (256MB) instead of read() calls.
+    - busy_timeout=5000: if another connection (e.g. another uvicorn worker) is writing,
+      wait up to 5 seconds for it to finish instead of failing with "database is locked".
+    - foreign_keys=ON: SQLite ignores the FOREIGN KEY rules in our schema unless we ask for
+      them, so this makes sure a message can never point at a user who doesn't exist.
+    '''
+    if not readonly:
+        conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-64000')
+    conn.execute('PRAGMA mmap_size=268435456')
+    conn.execute('PRAGMA busy_timeout=5000')
+    conn.execute('PRAGMA foreign_keys=ON')
+    return conn
+
+@contextmanager
+def get_db():
+    '''
+    Use as `with get_db() as conn:` to borrow a read-only connection from the pool.
+    We take a free one if there is one, open a new one while we have fewer than
+    READER_POOL_SIZE, and otherwise wait for one to be handed back (503 if that takes
+    longer than READER_WAIT_TIMEOUT seconds). LifoQueue hands out the most recently
+    returned connection first, whose page cache is most likely to still be useful.
+    '''
+    try:
+        conn = _readers.get_nowait()
+    except queue.Empty:
+        conn = None
+        with _connections_lock:
+            if len(_connections) < READER_POOL_SIZE:
+                conn = _connect(readonly=True)
+                _connections.append(conn)
+        if conn is None:
+            try:
+                conn = _readers.get(timeout=READER_WAIT_TIMEOUT)
+            except queue.Empty:
+                raise HTTPException(status_code=503, detail="Database is busy, try again")
+    try:
+        yield conn
+    finally:
+        _readers.put(conn)
+
+def get_writer():
+    """Return the one connection all writes go through, opening it on first use"""
+    global _writer_conn
+    if _writer_conn is None:
+        _writer_conn = _connect()
+    return _writer_conn
+
+@contextmanager
+def write_transaction():
+    '''
+    Use as `with write_transaction() as conn:` around anything that changes the database.
+    Only one thread at a time gets past _write_lock, and everything inside the block is one
+    transaction: committed at the end, or rolled back if something raised an error.
+    'yield' hands conn to the code inside the with block and waits here until it's done.
+    '''
+    with _write_lock:
+        conn = get_writer()
+        with conn:
+            yield conn
+
+@app.on_event("shutdown")
+def close_db():
+    """Close every reader connection we opened when the server stops"""
+    with _connections_lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+        # forget the closed connections, so if the app starts again the pool opens new ones
+        while not _readers.empty():
+            _readers.get_nowait()
+
+# SQL statements
+'''
+Before SQLite can run a query it has to parse the SQL text and plan how to run it.
+Each connection remembers the queries it has already prepared (cached_statements above),
+but only if it sees the exact same SQL string again. Keeping every query in this one
+dictionary guarantees each endpoint always sends identical text, so after the first
+request SQLite skips straight to running the query.
+(The one exception is the message INSERT, which is built per batch size - see
+_insert_messages_sql below.)
+'''
+# the columns and JOINs every chat history query shares (explained in fetchMessages below)
+_CHAT_SELECT = '''
+        SELECT m.messageId, m.content, m.timestamp,
+               s.userId as senderId, s.displayName as senderName,
+               r.userId as receiverId, r.displayName as receiverName
+        FROM messages m
+        JOIN users s ON m.senderId = s.userId
+        JOIN users r ON m.receiverId = r.userId
+'''
+
+STMTS = {
+    'get_user': 'SELECT displayName FROM users WHERE userId = ?',
+    'fetch_chat_after': _CHAT_SELECT + '''
+        WHERE m.senderId = ? AND (m.timestamp, m.messageId) > (?, ?)
+        UNION ALL''' + _CHAT_SELECT + '''
+        WHERE m.receiverId = ? AND m.senderId <> ? AND (m.timestamp, m.messageId) > (?, ?)
+        ORDER BY timestamp ASC, messageId ASC
+        LIMIT ?
+        ''',
+    'fetch_chat_page': _CHAT_SELECT + '''
+        WHERE m.senderId = ? AND (m.timestamp, m.messageId) < (?, ?)
+        UNION ALL''' + _CHAT_SELECT + '''
+        WHERE m.receiverId = ? AND m.senderId <> ? AND (m.timestamp, m.messageId) < (?, ?)
+        ORDER BY timestamp DESC, messageId DESC
+        LIMIT ?
+        ''',
+    # same conversion as scripts/sqlite_setup.py - see start_writer below
+    'convert_text_timestamps': '''
+        UPDATE messages
+        SET timestamp = CAST(strftime('%s', timestamp, 'utc') AS INTEGER) * 1000000
+                        + CAST(substr(substr(timestamp, 21) || '000000', 1, 6) AS INTEGER)
+        WHERE typeof(timestamp) = 'text'
+    ''',
+    'upsert_user': '''
+        INSERT INTO users (userId, displayName) VALUES (?, ?)
+        ON CONFLICT(userId) DO UPDATE SET displayName = excluded.displayName
+    ''',
+}
+
+# Batched message writes
+'''
+Every commit makes SQLite flush the write-ahead log to disk, and that flush is the slowest
+part of sending a message. When lots of messages arrive at once it's much cheaper to save
+them together and flush once.
+
+So message() doesn't write to the database itself. It puts the new row on a queue and waits.
+A single background thread (_write_messages) takes everything that is waiting on the queue,
+inserts it all with a single INSERT inside one transaction, commits once, and then tells
+each waiting request that its message is saved. When traffic is quiet a batch is just one
+message, so nobody waits for a batch to "fill up".
+
+A Future is a placeholder for a result that isn't ready yet (like a Promise in JavaScript).
+The writer thread fills it in with set_result() or set_exception(), and done.result() in
+save_message() waits until that happens - re-raising the error if the insert failed.
+
+save_message() never waits forever: if the commit hasn't happened after SAVE_TIMEOUT seconds
+the app gets a 503 ("try again later") instead of a request that hangs. done.cancel() takes the
+message back out: the writer skips any Future that was cancelled before it picked it up, so a
+503 really means "not saved" and trying again can't create a duplicate. The writer thread is
+normally started when the server starts (start_writer), but save_message() also starts it
+itself if it isn't running - e.g. when the startup hooks didn't run, or the thread died.
+'''
+MAX_BATCH_SIZE = 100
+SAVE_TIMEOUT = 10
+_pending_messages = queue.Queue()
+_writer_thread = None
+_writer_thread_lock = threading.Lock()
 
-    isinstance() checks if the variable is a certain type - here we check if it's a string.
-    If it is a string, we parse it using strptime() which converts strings to datetime objects.
-    If it's already a datetime object, we just return it as-is.
+'''
+Even executemany() still runs the INSERT once per row inside SQLite. Instead we write one
+INSERT that adds the whole batch at once:
+    INSERT INTO messages (...) VALUES (?, ?, ?, ?), (?, ?, ?, ?), (?, ?, ?, ?)
+with one "(?, ?, ?, ?)" group per message. Batches come in a handful of sizes, so we
+remember the SQL text we built for each size in _insert_sql (batch size -> SQL) and only
+build it the first time we see that size. Reusing the same text also lets the connection's
+statement cache skip re-parsing it. Only the writer thread uses this, so no lock is needed.
+'''
+_insert_sql = {}
+
+def _insert_messages_sql(count: int):
+    """Return an INSERT statement that adds `count` messages at once"""
+    sql = _insert_sql.get(count)
+    if sql is None:
+        sql = _insert_sql[count] = (
+            'INSERT INTO messages (senderId, receiverId, content, timestamp) VALUES '
+            + ', '.join(['(?, ?, ?, ?)'] * count))
+    return sql
+
+def _write_messages():
+    """Background thread: save queued messages in batches, one commit per batch"""
+    stopping = False
+    while not stopping:
+        item = _pending_messages.get()
+        if item is None:  # None is our signal to stop (see stop_writer)
+            break
+        batch = [item]
+        while len(batch) < MAX_BATCH_SIZE:
+            try:
+                item = _pending_messages.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                stopping = True
+                break
+            batch.append(item)
+
+        # claim each message; set_running_or_notify_cancel() is False if save_message gave up on it
+        batch = [(row, done) for row, done in batch if done.set_running_or_notify_cancel()]
+        if not batch:
+            continue
+
+        try:
+            with write_transaction() as conn:
+                # flatten [(a, b, c, d), (e, f, g, h)] into [a, b, c, d, e, f, g, h] to match the ?s
+                conn.execute(_insert_messages_sql(len(batch)), [value for row, _ in batch for value in row])
+        except Exception as e:
+            for _, done in batch:
+                done.set_exception(e)
+        else:
+            for _, done in batch:
+                done.set_result(None)
+
+def _ensure_writer():
+    """Start the writer thread unless it is already running"""
+    global _writer_thread
+    with _writer_thread_lock:
+        if _writer_thread is None or not _writer_thread.is_alive():
+            _writer_thread = threading.Thread(target=_write_messages, name="message-writer", daemon=True)
+            _writer_thread.start()
+
+def save_message(row):
+    """Queue a (senderId, receiverId, content, timestamp) row and wait until it is committed"""
+    _ensure_writer()
+    done = Future()
+    _pending_messages.put((row, done))
+    try:
+        done.result(timeout=SAVE_TIMEOUT)
+    except FutureTimeoutError:
+        if done.cancel():
+            raise HTTPException(status_code=503, detail="Message could not be saved in time, try again")
+        # too late to cancel: the writer is inserting it right now, so wait for the outcome
+        done.result()
+
+@app.on_event("startup")
+def start_writer():
+    """Convert any old text timestamps, then start the background thread that saves messages"""
+    '''
+    Older versions of Cipher saved timestamps as text ('2025-11-05 05:50:19.289720'). SQLite
+    sorts all text after all numbers, so those messages would never match our
+    "(timestamp, messageId) < ..." queries and would silently vanish from the chat history.
+    So before we serve anything we convert them to microseconds, exactly like
+    scripts/sqlite_setup.py does. Once every row is a number this finds nothing to change.
+    Opening the writer connection also switches the database to WAL mode if needed.
     '''
-    if isinstance(time_str, str):
-        return datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S.%f')
-    return time_str
+    with write_transaction() as conn:
+        conn.execute(STMTS['convert_text_timestamps'])
+    _ensure_writer()
+
+@app.on_event("shutdown")
+def stop_writer():
+    """Let the writer finish what's queued, then stop it and close the writer connection"""
+    global _writer_thread, _writer_conn
+    with _writer_thread_lock:
+        if _writer_thread is not None and _writer_thread.is_alive():
+            _pending_messages.put(None)
+            _writer_thread.join()
+        _writer_thread = None
+    with _write_lock:
+        if _writer_conn is not None:
+            _writer_conn.close()
+            _writer_conn = None
+
+'''
+FastAPI runs our normal (def, not async def) endpoints on a pool of worker threads, and by
+default that pool only has 40 threads. A request keeps its thread the whole time it runs -
+including while message() waits in save_message() for its batch to be committed. So with
+40 threads, at most 40 requests are in progress at once and a batch can never hold more than
+40 messages. We raise the limit to MAX_BATCH_SIZE so a busy burst can fill a whole batch.
+
+Threads are cheap while they wait. They don't each get a database connection: reads borrow
+one from the small get_db() pool only while their query runs. This has to be an async function
+because the thread pool belongs to the event loop, which only exists once the server is running.
+'''
+THREADPOOL_SIZE = MAX_BATCH_SIZE
+
+@app.on_event("startup")
+async def grow_threadpool():
+    """Let more sync endpoints run at the same time than FastAPI's default of 40"""
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
+# User lookups
+'''
+Every message needs the displayName of its sender and receiver, but users almost never change.
+The '?' in the query is a placeholder for security - the userId is passed separately in a tuple
+(userId,) instead of being pasted into the SQL, so nobody can sneak SQL in through a userId.
+
+So we remember each answer in _display_names, a dictionary of
+userId -> (displayName, time the entry expires). After the first lookup we get the name
+straight from memory instead of asking the database again.
+
+Entries expire after DISPLAY_NAME_TTL seconds. createUser removes the entry for the user it
+changes, but every uvicorn worker has its own copy of this dictionary and only the worker
+that handled createUser knows about the change - the expiry makes sure the other workers
+pick up a new displayName within a minute. time.monotonic() is a clock that never jumps
+backwards (unlike the wall clock), which is what we want for measuring "how long ago".
+
+We keep at most DISPLAY_NAME_CACHE_SIZE names; when it's full we drop the entry that was
+added first (dictionaries remember the order things were added in). The lock makes sure
+two threads don't both try to drop the same entry at once.
+
+If the user doesn't exist we raise an HTTPException and remember nothing, so a user who is
+created later will be found on the next try.
+'''
+DISPLAY_NAME_TTL = 60
+DISPLAY_NAME_CACHE_SIZE = 10_000
+_display_names = {}
+_display_names_lock = threading.Lock()
+
+def _display_name(userId: str):
+    """Look up a user's displayName, raising a 404 if they don't exist"""
+    now = time.monotonic()
+    cached = _display_names.get(userId)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+
+    with get_db() as conn:
+        row = conn.execute(STMTS['get_user'], (userId,)).fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail=f"User {userId} not found")
+
+    with _display_names_lock:
+        _display_names.pop(userId, None)
+        if len(_display_names) >= DISPLAY_NAME_CACHE_SIZE:
+            del _display_names[next(iter(_display_names))]
+        _display_names[userId] = (row[0], now + DISPLAY_NAME_TTL)
+    return row[0]
 
 # TODO: WS /ws/typing  
 # TODO: GET /api/presence
@@ -134,79 +597,54 @@ def message(content: str, senderId: str, receiverId: str):
     Below I'll explain some of the basic concepts.
     
     if you read the README.md I have scripts you need to run that will do the work of setting up the db file and all of that for you 
-    by now the folder and file should be there already and you can just pass 'storage/cipher.db' above.
-
-    Everything inside of the `with` clause below is what happens while we have opened our local database.
-    After the with clause ends (indicated by the end of indented code under it) the connection to our db file is closed.
+    by now the folder and file should be there already and get_db() just hands us a connection to 'storage/cipher.db'.
     '''
-    with sqlite3.connect('storage/cipher.db') as conn: # here i give the location of my local db file.
-
-        cursor = conn.cursor() # the cursor is just how we run our queries to fetch the data, so defining it here.
-
-        # fetch displayName (validate users exist)
-        # through our cursor I run the query "SELECT  . . . " to get the displayNames for the two users
-        # the one who wrote the msg and the one who will receive it (mohammad > khader)
-        '''
-        The '?' in the SQL query is a placeholder for security. Instead of putting the value
-        directly in the string (which could allow SQL injection attacks), we pass it separately
-        in a tuple (senderId,) - note the comma makes it a tuple even with one item.
-
-        fetchone() gets one row from the results, and [0] gets the first column (displayName).
-
-        If the user doesn't exist, sender_name will be None, so we raise an HTTPException.
-        This is like throwing an error in mobile dev - it stops execution and returns a 404
-        error to whoever made the request.
-        '''
-        cursor.execute('SELECT displayName FROM users WHERE userId = ?', (senderId,))
-        sender_name = cursor.fetchone()
-        if not sender_name:
-            raise HTTPException(status_code=404, detail=f"User {senderId} not found")
-
-        # Same validation for the receiver - make sure they exist in the database
-        cursor.execute('SELECT displayName FROM users WHERE userId = ?', (receiverId,))
-        receiver_name = cursor.fetchone()
-        if not receiver_name:
-            raise HTTPException(status_code=404, detail=f"User {receiverId} not found")
+    # fetch displayName (validate users exist)
+    # _display_name() gets the displayNames for the two users from our cache (or the database the first time)
+    # the one who wrote the msg and the one who will receive it (mohammad > khader)
+    # If either user doesn't exist it raises a 404 error for us and we stop right here.
+    sender_name = _display_name(senderId)
+    receiver_name = _display_name(receiverId)
 
-        '''
-        Now that we've validated both users exist, we create User objects for them.
-        Remember our User class from the top? We're creating instances of it here.
+    '''
+    Now that we've validated both users exist, we create User objects for them.
+    Remember our User class from the top? We're creating instances of it here.
 
-        This is like creating a struct/object in Swift or a data class in Kotlin.
-        '''
-        sender = User(userId=senderId, displayName=sender_name[0])
-        receiver = User(userId=receiverId, displayName=receiver_name[0])
+    This is like creating a struct/object in Swift or a data class in Kotlin.
+    '''
+    sender = User(userId=senderId, displayName=sender_name)
+    receiver = User(userId=receiverId, displayName=receiver_name)
 
-        '''
-        Now we create our Message object with all the required fields.
-        datetime.now() gets the current time - this is when the message was created.
+    '''
+    Now we create our Message object with all the required fields.
+    time.time_ns() // 1000 gets the current time in microseconds - this is when the message
+    was created. We save that number as-is, and turn it into a datetime for our response.
 
-        This Message object now has everything: who sent it, who receives it,
-        what the content is, and when it was sent.
-        '''
-        msg = Message(
-            sender=sender,
-            receiver=receiver,
-            content=content,
-            timestamp=datetime.now()
-        )
-
-        # SQLite upload of the message
-        '''
-        INSERT INTO is the SQL command to add a new row to a table.
-        We're inserting into the 'messages' table, specifying which columns we're filling,
-        and providing the values with the ? placeholders again for security.
+    This Message object now has everything: who sent it, who receives it,
+    what the content is, and when it was sent.
+    '''
+    sent_at = time.time_ns() // 1000
+    msg = Message(
+        sender=sender,
+        receiver=receiver,
+        content=content,
+        timestamp=micros_to_datetime(sent_at)
+    )
+
+    # SQLite upload of the message
+    '''
+    INSERT INTO is the SQL command to add a new row to a table.
+    We're inserting into the 'messages' table, specifying which columns we're filling,
+    and providing the values with the ? placeholders again for security.
 
-        The VALUES clause provides the actual data in the same order as the columns listed.
+    The VALUES clause provides the actual data in the same order as the columns listed.
 
-        conn.commit() is CRITICAL - it saves the changes to the database. Without this,
-        the message would never actually be saved! Think of it like hitting "save" after
-        editing a document.
-        '''
-        cursor.execute('INSERT INTO messages (senderId, receiverId, content, timestamp) VALUES (?, ?, ?, ?)',
-                       (msg.sender.userId, msg.receiver.userId, msg.content, msg.timestamp)
-                       )
-        conn.commit()
+    We don't run the INSERT here - save_message() hands the row to the writer thread
+    (see "Batched message writes" above), which inserts and commits it together with any
+    other messages that arrived at the same time. save_message() only returns once the
+    commit is done, so when we reply to the client the message is really saved.
+    '''
+    save_message((msg.sender.userId, msg.receiver.userId, msg.content, sent_at))
 
     '''
     This print statement is just for debugging - it shows in the server logs that the
@@ -226,21 +664,36 @@ This is a GET endpoint (not POST like above). GET is for retrieving data, not cr
 When the mobile app wants to load the chat history, it calls this endpoint.
 '''
 @app.get("/api/message")
-def fetchMessages(userId: str):
+def fetchMessages(userId: str, before: Optional[str] = Query(None, pattern=r"^\d{1,18}_\d{1,18}$"),
+                  limit: int = Query(50, ge=1, le=500)):
     '''
-    This function fetches all messages where the user is either the sender OR receiver.
-    So if mohammad calls this, he gets all messages he sent and all messages sent to him.
+    This function fetches messages where the user is either the sender OR receiver.
+    So if mohammad calls this, he gets messages he sent and messages sent to him.
+
+    It returns one "page" at a time: the newest `limit` messages (50 unless the app asks for
+    more, at most 500), oldest first. Along with the page we send `next_before`, and to load
+    older messages the app passes it back as `before` to get the page just before that.
+    This is called keyset pagination. Thanks to our timestamp indexes SQLite jumps straight
+    to the right spot, so page 100 is just as fast as page 1 (unlike OFFSET, which would have
+    to count past every skipped message).
+
+    `next_before` is "<timestamp>_<messageId>" of the oldest message in the page. The timestamp
+    alone isn't enough: two messages can be sent in the same microsecond (e.g. by two uvicorn
+    workers), and "timestamp < before" would skip the one that didn't make it onto the page.
+    messageId breaks the tie, so every message shows up exactly once. The app should treat it
+    as an opaque string and just hand it back. It is None when there are no older messages.
+    pattern= makes FastAPI reject anything that doesn't look like that with a 422 error.
     '''
-    with sqlite3.connect('storage/cipher.db') as conn:
+    with get_db() as conn:
         '''
-        row_factory = sqlite3.Row makes it so we can access columns by name instead of index.
-        Instead of row[0], row[1], we can do row['content'], row['timestamp'] which is
-        much clearer and less error-prone.
+        get_db() sets row_factory = sqlite3.Row, which makes it so we can access columns by
+        name instead of index. Instead of row[0], row[1], we can do row['content'],
+        row['timestamp'] which is much clearer and less error-prone.
         '''
-        conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         '''
-        This is a more complex SQL query using JOIN. Let me break it down:
+        This runs the 'fetch_chat_page' query from STMTS above, a more complex SQL query using JOIN.
+        Let me break it down:
 
         - We're selecting from the messages table (aliased as 'm')
         - JOIN users s means join with the users table (aliased as 's' for sender)
@@ -251,51 +704,77 @@ def fetchMessages(userId: str):
         Why JOIN? Because the messages table only stores userId strings, but we want
         the full user information (displayName) for both sender and receiver.
 
-        WHERE m.senderId = ? OR m.receiverId = ? filters to messages where our user
-        is involved (either sending or receiving).
-
-        ORDER BY m.timestamp ASC sorts messages by time, oldest first (ASC = ascending).
+        We want messages where our user is involved (either sending or receiving), so the
+        query is really two queries glued together with UNION ALL:
+        - the first half gets messages our user sent (WHERE m.senderId = ?)
+        - the second half gets messages our user received (WHERE m.receiverId = ?),
+          skipping ones they sent to themselves (AND m.senderId <> ?) since the first
+          half already has those
+
+        Why not just WHERE m.senderId = ? OR m.receiverId = ? ? Because SQLite can't use
+        an index for an OR across two columns, so it would read every message in the table.
+        Each half on its own can jump straight to the right rows using the
+        idx_messages_sender_ts / idx_messages_receiver_ts indexes (see scripts/sqlite_setup.py).
+        That's why we pass userId three times, and `before` once for each half.
+
+        (m.timestamp, m.messageId) < (?, ?) compares the pair the way a dictionary orders words:
+        an earlier timestamp, or the same timestamp and a smaller messageId. When the app didn't
+        pass `before` we use the biggest numbers SQLite can store, so it matches everything and
+        we can keep using one query.
+
+        ORDER BY timestamp DESC, messageId DESC sorts messages by time, newest first
+        (DESC = descending), and LIMIT ? stops after `limit` messages - so we get the newest
+        page. The indexes are already sorted that way (SQLite keeps the messageId at the end of
+        every index entry), so SQLite just merges the two halves and stops early.
         '''
-        cursor.execute(
-            '''
-            SELECT m.content, m.timestamp,
-                   s.userId as senderId, s.displayName as senderName,
-                   r.userId as receiverId, r.displayName as receiverName
-            FROM messages m
-            JOIN users s ON m.senderId = s.userId
-            JOIN users r ON m.receiverId = r.userId
-            WHERE m.senderId = ? OR m.receiverId = ?
-            ORDER BY m.timestamp ASC
-            ''', (userId, userId))
+        if before:
+            before_micros, before_id = (int(part) for part in before.split('_'))
+        else:
+            before_micros = before_id = 2**63 - 1
+        cursor.execute(STMTS['fetch_chat_page'],
+                       (userId, before_micros, before_id, userId, userId, before_micros, before_id, limit))
 
         '''
-        chat_history = [] creates an empty list (similar to arrays in mobile dev).
-        We'll fill this list with Message objects.
+        Looping over the cursor itself hands us the rows one at a time as SQLite produces
+        them. (cursor.fetchall() would first copy ALL rows into a list, and then we'd copy
+        them again into chat_history - twice the memory for a long chat.)
+        After the loop, `row` is still the last (oldest) row, which we need for next_before.
+
+        For each row we build a plain dictionary with the same shape as our Message model
+        (sender, receiver, content, timestamp). We don't create Message/User objects here:
+        pydantic would re-check every field of data that just came out of our own database,
+        and then FastAPI would turn those objects back into dictionaries anyway.
+
+        A chat is usually between the same two people over and over, so instead of building
+        a new sender/receiver dictionary for every single message, user() builds one per
+        person and hands back that same dictionary every time that person shows up again.
+        users is a dictionary of userId -> that person's dictionary.
+
+        We use micros_to_datetime() (our util function from the top) to convert the
+        timestamp number from the database into a proper datetime object.
+        '''
+        users = {}
 
-        cursor.fetchall() gets ALL rows from the query result (unlike fetchone() which
-        gets just one row).
+        def user(userId, displayName):
+            found = users.get(userId)
+            if found is None:
+                found = users[userId] = {'displayName': displayName, 'userId': userId}
+            return found
 
-        The for loop iterates through each row - this is like a for-each loop in Swift/Kotlin.
-        '''
         chat_history = []
-        for row in cursor.fetchall():
-            '''
-            For each row from the database, we create a Message object.
-            Notice how we're creating User objects inline here - we don't store them
-            in variables because we only need them to create the Message.
-
-            We use parse_time() (our util function from the top) to convert the timestamp
-            string from the database into a proper datetime object.
-
-            Then we append (add) this message to our chat_history list.
-            '''
-            msg = Message(
-                sender=User(userId=row['senderId'], displayName=row['senderName']),
-                receiver=User(userId=row['receiverId'], displayName=row['receiverName']),
-                content=row['content'],
-                timestamp=parse_time(row["timestamp"])
-            )
-            chat_history.append(msg)
+        row = None
+        for row in cursor:
+            chat_history.append({
+                'sender': user(row['senderId'], row['senderName']),
+                'receiver': user(row['receiverId'], row['receiverName']),
+                'content': row['content'],
+                'timestamp': micros_to_datetime(row['timestamp']),
+            })
+        # the query gave us newest first; flip it so the app gets the page oldest first
+        chat_history.reverse()
+
+        # a full page means there may be older messages; a shorter one means we reached the start
+        next_before = f"{row['timestamp']}_{row['messageId']}" if len(chat_history) == limit else None
 
         '''
         len() gets the length of the list - how many messages we found.
@@ -304,11 +783,69 @@ def fetchMessages(userId: str):
         print(f"messages to & from {userId}: {len(chat_history)} messages")
 
     '''
-    Return the chat history as a dictionary. FastAPI converts this to JSON automatically,
-    so the mobile app receives a JSON object with a "chat_history" array containing
-    all the messages.
+    Return the chat history as JSON, so the mobile app receives a JSON object with a
+    "chat_history" array containing all the messages, and the "next_before" cursor.
+
+    We wrap it in ORJSONResponse ourselves: when we return a plain dictionary FastAPI
+    first walks through every value to make it JSON-friendly, but orjson already knows
+    how to handle strings, lists and datetimes, so we skip that extra pass.
+    '''
+    return ORJSONResponse({"chat_history": chat_history, "next_before": next_before})
+
+# Stream all the messages sent to and by the user, one JSON object per line
+'''
+fetchMessages builds the whole chat history in memory before sending any of it. For a user
+with a huge history that's a lot of memory, and the app sees nothing until it's all built.
+
+This endpoint returns the same messages as NDJSON ("newline-delimited JSON"): every message
+is its own JSON object on its own line, sent as soon as it's read. StreamingResponse sends
+whatever our generator yields piece by piece, so the server only ever holds one chunk of
+STREAM_CHUNK_SIZE messages at a time.
+
+A generator is a function that uses 'yield' instead of 'return' - it hands back one value,
+pauses, and continues from the same spot when the next value is asked for.
+'''
+STREAM_CHUNK_SIZE = 500
+
+@app.get("/api/message/stream")
+def streamMessages(userId: str):
+    '''
+    We don't run one big query and read from it while we send. A query that is still open
+    keeps SQLite from cleaning up its write-ahead log, and a slow phone could keep it open
+    for minutes. Instead we read the history in pages of STREAM_CHUNK_SIZE messages, the same
+    keyset way as fetchMessages but going forwards: each page starts right after the
+    (timestamp, messageId) of the last message we sent. Every page is a short query that
+    is completely finished (fetchall) before we send anything.
+
+    Each page borrows a connection from the get_db() pool only for its own query, and hands
+    it back before we send the page - so a slow download never holds on to a connection,
+    and there's no new connection to open per stream.
     '''
-    return {"chat_history": chat_history}
+    def lines():
+        # start before the very first message (no real message has a negative timestamp or id)
+        after_micros = after_id = -1
+        while True:
+            with get_db() as conn:
+                rows = conn.execute(STMTS['fetch_chat_after'], (
+                    userId, after_micros, after_id, userId, userId, after_micros, after_id, STREAM_CHUNK_SIZE
+                )).fetchall()
+            if not rows:
+                break
+            yield b''.join(
+                orjson.dumps({
+                    'sender': {'displayName': row['senderName'], 'userId': row['senderId']},
+                    'receiver': {'displayName': row['receiverName'], 'userId': row['receiverId']},
+                    'content': row['content'],
+                    'timestamp': micros_to_datetime(row['timestamp']),
+                }) + b'\n'
+                for row in rows
+            )
+            # a page that isn't full was the last one
+            if len(rows) < STREAM_CHUNK_SIZE:
+                break
+            after_micros, after_id = rows[-1]['timestamp'], rows[-1]['messageId']
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 # Create a new user
 '''
@@ -321,21 +858,28 @@ def createUser(userId: str, displayName: str):
     Takes two parameters:
     - userId: the unique identifier (like a username)
     - displayName: the name we show to other users
+
+    This changes the database, so it goes through write_transaction() (see the top of the
+    file) which gives us the writer connection and commits for us at the end of the block.
     '''
-    with sqlite3.connect('storage/cipher.db') as conn:
+    with write_transaction() as conn:
         cursor = conn.cursor()
 
         '''
-        INSERT OR REPLACE is special - it means:
+        INSERT ... ON CONFLICT DO UPDATE is an "upsert" (update or insert) - it means:
         - If this userId doesn't exist, INSERT it (create new user)
-        - If this userId already exists, REPLACE it (update the user)
+        - If this userId already exists, UPDATE its displayName in place (update the user)
 
         This is useful because we don't have to check if the user exists first.
-        It's like an "upsert" operation (update or insert).
+        `excluded.displayName` is the value we just tried to insert.
+        (INSERT OR REPLACE would also work, but on a clash it deletes the old row and inserts
+        a brand new one, which is more work for the database than changing one column.)
         '''
-        cursor.execute('INSERT OR REPLACE INTO users (userId, displayName) VALUES (?, ?)',
-                  (userId, displayName))
-        conn.commit()
+        cursor.execute(STMTS['upsert_user'], (userId, displayName))
+
+    # forget this user's cached displayName so message() sees the new/updated name
+    with _display_names_lock:
+        _display_names.pop(userId, None)
 
     '''
     Return the user information we just created/updated. This confirms to the
@@ -343,25 +887,111 @@ def createUser(userId: str, displayName: str):
     '''
     return {"userId": userId, "displayName": displayName}
 
+# Run several API calls in one round-trip
+'''
+When the app opens it needs several things at once (e.g. the chat history and, later, who's
+online). Every separate HTTP request pays for its own trip over the network, which is slow on
+a phone. /api/batch lets the app send them all in one request:
+
+    {"requests": [{"id": "history", "method": "GET", "url": "/api/message?userId=khader"}, ...]}
+
+and get back every answer together:
+
+    {"responses": [{"id": "history", "status": 200, "body": {"chat_history": [...]}}, ...]}
+
+httpx is an HTTP client library. ASGITransport makes it "send" requests straight into our own
+app in memory instead of over the network, so each sub-request runs through the normal
+endpoint exactly as if it came from outside. asyncio.gather() starts them all at once and waits
+until every one has finished, so the batch takes about as long as the slowest request, not the
+sum of all of them. raise_app_exceptions=False turns a crash in one sub-request into a 500
+response for that item instead of failing the whole batch.
+
+Every sub-request carries a BATCH_HEADER header, and batch() refuses any request that has it.
+BatchItem already refuses "/api/batch" as a url, but this makes sure that however a url is
+written, a batch can never end up running another batch (which could multiply into
+thousands of requests). We also ask for "Accept-Encoding: identity" (no compression):
+otherwise GZipMiddleware would compress every sub-response, httpx would uncompress it
+again, and then the whole batch answer gets compressed once more on the way out.
+'''
+MAX_BATCH_REQUESTS = 20
+BATCH_HEADER = "x-cipher-batch"
+
+@app.post("/api/batch")
+async def batch(payload: BatchRequest, request: Request):
+    if len(payload.requests) > MAX_BATCH_REQUESTS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_REQUESTS} requests per batch")
+    # a batch inside a batch could go on forever, so we don't allow it
+    if BATCH_HEADER in request.headers:
+        raise HTTPException(status_code=400, detail="/api/batch can't be called from inside a batch")
+
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    headers = {"Accept-Encoding": "identity", BATCH_HEADER: "1"}
+    async with httpx.AsyncClient(transport=transport, base_url="http://cipher", headers=headers) as client:
+        responses = await asyncio.gather(*(
+            client.request(item.method, item.url, json=item.body)
+            for item in payload.requests
+        ))
+
+    results = []
+    for item, response in zip(payload.requests, responses):
+        # JSON answers are passed through as JSON; anything else (like the HTML page) as text
+        if response.headers.get("content-type", "").startswith("application/json"):
+            body = response.json()
+        else:
+            body = response.text
+        results.append({"id": item.id, "status": response.status_code, "body": body})
+    return {"responses": results}
+
 '''
 This is the root endpoint - when you visit http://localhost:8000/ in a browser,
 this function handles it. It serves our frontend HTML page.
 
-Notice this is an async function - async/await in Python is similar to async/await
-in Swift. It allows the function to handle other requests while waiting for I/O
-operations (like reading files).
+The page never changes while the server is running, so we read index.html from disk
+once, right here when the server starts, and keep the bytes in INDEX_HTML. Every
+visit after that is served straight from memory - no opening and reading the file again.
+'rb' means "read binary": we keep the raw bytes since that's what gets sent anyway.
+
+INDEX_ETAG is a fingerprint (an md5 hash) of those bytes, worked out once as well. The browser
+remembers it and sends it back in an If-None-Match header the next time it asks for the page.
+If it still matches, we answer 304 Not Modified with no body and the browser reuses its copy.
+The W/ in front makes it a "weak" ETag, meaning "same page, but maybe not byte for byte":
+GZipMiddleware sends the page compressed to some clients and plain to others with this same
+ETag, and proxies often add W/ themselves when they compress. _etag_matches() below
+accepts it with or without the W/, in a comma-separated list, or "*" (matches anything).
+
+Notice root() is an async function - async/await in Python is similar to async/await
+in Swift. There's no waiting left to do in it, and async functions run directly on the
+server's event loop instead of being handed off to a worker thread, which is cheaper.
 '''
+with open("frontend/index.html", "rb") as f:
+    INDEX_HTML = f.read()
+INDEX_ETAG = 'W/"' + hashlib.md5(INDEX_HTML).hexdigest() + '"'
+INDEX_HEADERS = {"Cache-Control": "public, max-age=60", "ETag": INDEX_ETAG}
+
+def _etag_matches(if_none_match: Optional[str], etag: str):
+    """Check an If-None-Match header against our ETag (ignoring W/, like the HTTP spec says)"""
+    if not if_none_match:
+        return False
+    ours = etag.removeprefix('W/')
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag.removeprefix('W/') == ours:
+            return True
+    return False
+
 @app.get("/")
-async def root():
+async def root(request: Request):
     '''
-    Opens the index.html file from the frontend folder and reads its contents.
-    The 'with' statement ensures the file is properly closed after reading.
-
     HTMLResponse tells FastAPI to return this as HTML (not JSON), so the browser
     renders it as a web page.
+
+    The Cache-Control header lets the browser keep its own copy of the page for 60 seconds,
+    so reloading within that time doesn't even need to ask the server.
+    After that it asks again with the ETag, and usually gets a tiny 304 back.
     '''
-    with open("frontend/index.html") as f:
-        return HTMLResponse(f.read())
+    if _etag_matches(request.headers.get("if-none-match"), INDEX_ETAG):
+        return Response(status_code=304, headers=INDEX_HEADERS)
+    return HTMLResponse(INDEX_HTML, headers=INDEX_HEADERS)
 
 '''
 app.mount() makes a whole directory available for serving static files (CSS, JS, images).
@@ -380,13 +1010,21 @@ if __name__ == "__main__" is a Python idiom that means "only run this code if th
 file is being run directly, not if it's being imported."
 
 uvicorn is the web server that runs our FastAPI application. We tell it to:
-- Run our 'app' object
+- Run the 'app' object from backend.py ("backend:app")
 - Listen on all network interfaces (0.0.0.0)
 - Use port 8000
+- uvicorn picks uvloop (a much faster event loop written in C) and httptools (a fast HTTP
+  parser) by itself when they're installed - uvicorn[standard] in requirements.txt installs
+  them (except uvloop on Windows, where uvicorn falls back to the normal event loop).
+- Start one worker process per CPU core. A single Python process only really uses one
+  core at a time, so with several workers we can handle requests on all of them. Each
+  worker is a full copy of this file with its own connections, writer thread and caches.
+  That's also why we pass "backend:app" as a string: every worker imports the app itself.
 
 So when you run 'python backend.py', uvicorn starts up and your API is available
 at http://localhost:8000
 '''
 if __name__ == "__main__":
+    import os
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run("backend:app", host="0.0.0.0", port=8000, workers=os.cpu_count())
@@ -4,10 +4,6 @@ from datetime import datetime, timedelta
 conn = sqlite3.connect('storage/cipher.db')
 c = conn.cursor()
 
-# Clear existing data (optional - remove if you want to keep existing data)
-c.execute('DELETE FROM messages')
-c.execute('DELETE FROM users')
-
 # Seed users
 users = [
     ('mohammad', 'Mohammad S. Khalaf'),
@@ -15,10 +11,6 @@ users = [
     ('alice', 'Alice Johnson')
 ]
 
-for userId, displayName in users:
-    c.execute('INSERT OR REPLACE INTO users (userId, displayName) VALUES (?, ?)',
-              (userId, displayName))
-
 # Seed messages - conversation about Cipher app
 base_time = datetime.now() - timedelta(hours=2)
 
@@ -40,13 +32,25 @@ messages = [
     ('khader', 'alice', 'Thank you! It was a lot of work but totally worth it', base_time + timedelta(hours=1, minutes=18))
 ]
 
-for senderId, receiverId, content, timestamp in messages:
-    c.execute('''
+# Everything below runs as one transaction: nothing is saved until the end of the `with`
+# block, and then it's all committed (and synced to disk) at once - or rolled back if anything fails.
+with conn:
+    # Clear existing data (optional - remove if you want to keep existing data)
+    c.execute('DELETE FROM messages')
+    c.execute('DELETE FROM users')
+
+    # executemany hands the whole list to SQLite in one call, instead of one execute() per row
+    c.executemany('INSERT OR REPLACE INTO users (userId, displayName) VALUES (?, ?)', users)
+
+    # timestamps are stored as microseconds since 1970, worked out with whole numbers only
+    # (see micros_to_datetime in backend.py) so floating point can't be off by one
+    c.executemany('''
         INSERT INTO messages (senderId, receiverId, content, timestamp)
         VALUES (?, ?, ?, ?)
-    ''', (senderId, receiverId, content, timestamp))
+    ''', [(senderId, receiverId, content,
+           int(timestamp.replace(microsecond=0).timestamp()) * 1_000_000 + timestamp.microsecond)
+          for senderId, receiverId, content, timestamp in messages])
 
-conn.commit()
 conn.close()
 
 print("✓ Seeded the Data")
\ No newline at end of file
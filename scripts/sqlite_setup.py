@@ -7,6 +7,10 @@ os.makedirs('storage', exist_ok=True)
 conn = sqlite3.connect('storage/cipher.db')
 c = conn.cursor()
 
+# Write-ahead logging: readers and the writer don't block each other. This setting is saved in
+# the database file, so it only needs to be set once (the backend sets its other PRAGMAs itself).
+c.execute('PRAGMA journal_mode=WAL')
+
 # Create the Users table
 c.execute('''
     CREATE TABLE IF NOT EXISTS users (
@@ -22,10 +26,26 @@ c.execute('''
         senderId TEXT,
         receiverId TEXT,
         content TEXT,
-        timestamp DATETIME,
+        timestamp INTEGER,
         FOREIGN KEY (senderId) REFERENCES users(userId),
         FOREIGN KEY (receiverId) REFERENCES users(userId)
     )
 ''')
 
+# timestamps are microseconds since 1970 (see micros_to_datetime in backend.py).
+# Older databases stored them as text like '2025-11-05 05:50:19.289720' in local time, so convert
+# those rows: strftime('%s', ..., 'utc') gives the whole seconds, and the digits after the '.'
+# (padded to 6) give the microseconds.
+c.execute('''
+    UPDATE messages
+    SET timestamp = CAST(strftime('%s', timestamp, 'utc') AS INTEGER) * 1000000
+                    + CAST(substr(substr(timestamp, 21) || '000000', 1, 6) AS INTEGER)
+    WHERE typeof(timestamp) = 'text'
+''')
+conn.commit()
+
+# indexes for fetching a user's chat history (sent and received), already sorted by time
+c.execute('CREATE INDEX IF NOT EXISTS idx_messages_sender_ts ON messages(senderId, timestamp)')
+c.execute('CREATE INDEX IF NOT EXISTS idx_messages_receiver_ts ON messages(receiverId, timestamp)')
+
 